@@ -1,9 +1,176 @@
 import streamlit as st
-from google.cloud import speech
-from google.oauth2 import service_account
+# google.cloud / av は重いため、必要になった時点で関数内でインポートする
 #import google.generativeai as genai # Gemini API ライブラリをインポート
 import json
 import io
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+SAMPLE_RATE = 16000 # Google Cloud STT に送る PCM のサンプリングレート
+INLINE_MAX_SEC = 55 # 同期 recognize に直接送る音声の上限 (API の上限は約 1 分)
+CUT_SEARCH_SEC = 5 # 分割位置を探す範囲 (チャンク末尾から遡る秒数)
+MIN_TAIL_SEC = 4 # これより短い最後の端数は直前のチャンクに結合する (結合後も 60 秒未満に収まる)
+CUT_FRAME_SAMPLES = SAMPLE_RATE // 50 # 分割位置探索の音量計算単位 (20ms)
+MAX_RECOGNIZE_WORKERS = 8 # 並列に投げる recognize リクエスト数の上限
+
+
+# デコード済み PCM は 1 時間あたり約 115MB になるため、保持する件数と期間を制限する
+@st.cache_data(show_spinner=False, max_entries=4, ttl=3600)
+def decode_to_pcm16k(file_id, _audio_file):
+    """アップロードされた音声ファイルを PyAV で 16kHz モノラル 16bit PCM (s16le) に変換する
+
+    キャッシュのキーは file_id のみ (_audio_file は先頭の _ によりハッシュ対象外)。
+    ファイル全体をコピー・ハッシュせずに、UploadedFile (BytesIO) から直接読み込む。
+    file_id はアップロードごとに変わるため、同じファイルを再アップロードしたり別セッションから
+    アップロードしたりしてもエントリは共有されない。ここで狙っているのは同一アップロードでの
+    再実行時の再利用だけであり、重複エントリによるメモリ増加は max_entries / ttl で上限を設けている。
+    """
+    import av
+
+    pcm_chunks = []
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+    try:
+        _audio_file.seek(0)
+        with av.open(_audio_file) as container:
+            stream = container.streams.audio[0]
+            for frame in container.decode(stream):
+                for resampled in resampler.resample(frame):
+                    pcm_chunks.append(resampled.to_ndarray().tobytes())
+        # リサンプラー内に残ったサンプルを取り出す
+        for resampled in resampler.resample(None):
+            pcm_chunks.append(resampled.to_ndarray().tobytes())
+    except (av.error.FFmpegError, IndexError) as e:
+        raise RuntimeError(f"PyAV による音声デコードに失敗しました: {e}")
+    return b"".join(pcm_chunks)
+
+
+@st.cache_resource
+def load_speech_client(credentials_json_str):
+    """認証情報から SpeechClient を生成する (再実行のたびに gRPC チャネルを作り直さないようキャッシュ)"""
+    from google.cloud import speech
+    from google.oauth2 import service_account
+
+    credentials = service_account.Credentials.from_service_account_info(json.loads(credentials_json_str))
+    return speech.SpeechClient(credentials=credentials)
+
+
+@st.cache_resource
+def load_storage_client(credentials_json_str):
+    """認証情報から Cloud Storage クライアントを生成する"""
+    from google.cloud import storage
+    from google.oauth2 import service_account
+
+    credentials = service_account.Credentials.from_service_account_info(json.loads(credentials_json_str))
+    return storage.Client(credentials=credentials, project=credentials.project_id)
+
+
+def long_running_recognize_via_gcs(speech_client, storage_client, bucket_name, content, config):
+    """PCM を GCS に一時アップロードし、long_running_recognize で文字起こしする"""
+    from google.cloud import speech
+
+    blob = storage_client.bucket(bucket_name).blob(f"stt-uploads/{uuid.uuid4().hex}.raw")
+    blob.upload_from_string(content, content_type="application/octet-stream")
+    try:
+        audio = speech.RecognitionAudio(uri=f"gs://{bucket_name}/{blob.name}")
+        operation = speech_client.long_running_recognize(config=config, audio=audio)
+        duration_sec = len(content) / (SAMPLE_RATE * 2)
+        return operation.result(timeout=max(300, int(duration_sec)))
+    finally:
+        # 一時ファイルは結果取得後に削除する
+        # (削除に失敗しても文字起こし結果や本来のエラーを失わないよう、警告に留める)
+        try:
+            blob.delete()
+        except Exception as e:
+            st.warning(f"GCS 上の一時ファイル gs://{bucket_name}/{blob.name} を削除できませんでした: {e}")
+
+
+def split_pcm(content):
+    """PCM を最大 INLINE_MAX_SEC 秒の区間に分割し、(開始サンプル, 終了サンプル) のリストを返す
+
+    単語の途中で切らないよう、各区間の末尾 CUT_SEARCH_SEC 秒の中で最も音量の小さい位置で区切る。
+    """
+    samples = np.frombuffer(content, dtype=np.int16)
+    chunk_samples = INLINE_MAX_SEC * SAMPLE_RATE
+    search_samples = CUT_SEARCH_SEC * SAMPLE_RATE
+    min_tail_samples = MIN_TAIL_SEC * SAMPLE_RATE
+
+    bounds = []
+    start = 0
+    # 残りが「1 区間 + 短い端数」に収まるまで区切る (端数は最後の区間に含める)
+    while len(samples) - start > chunk_samples + min_tail_samples:
+        window_start = start + chunk_samples - search_samples
+        window = samples[window_start:start + chunk_samples].astype(np.int32)
+        frames = window[:len(window) // CUT_FRAME_SAMPLES * CUT_FRAME_SAMPLES].reshape(-1, CUT_FRAME_SAMPLES)
+        quietest = int(np.abs(frames).sum(axis=1).argmin())
+        end = window_start + quietest * CUT_FRAME_SAMPLES + CUT_FRAME_SAMPLES // 2
+        bounds.append((start, end))
+        start = end
+    bounds.append((start, len(samples)))
+    return bounds
+
+
+def format_timestamp(sample_index):
+    """サンプル位置を H:MM:SS 形式の時刻文字列にする"""
+    minutes, seconds = divmod(sample_index // SAMPLE_RATE, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def recognize_in_chunks(speech_client, content, config):
+    """PCM を約 INLINE_MAX_SEC 秒ごとに分割して同期 recognize を並列に実行し、(区間ラベル, レスポンス) を順番に返す"""
+    from google.cloud import speech
+
+    bounds = split_pcm(content)
+    labels = [f"{format_timestamp(start)} 〜 {format_timestamp(end)}" for start, end in bounds]
+    chunks = [content[start * 2:end * 2] for start, end in bounds]
+    executor = ThreadPoolExecutor(max_workers=min(MAX_RECOGNIZE_WORKERS, len(chunks)))
+
+    def submit(chunk):
+        return executor.submit(speech_client.recognize, config=config, audio=speech.RecognitionAudio(content=chunk))
+
+    try:
+        # 同時に投げるのは MAX_RECOGNIZE_WORKERS 件まで。1 件受け取るごとに次のチャンクを送る
+        pending = deque(submit(chunk) for chunk in chunks[:MAX_RECOGNIZE_WORKERS])
+        next_chunks = iter(chunks[MAX_RECOGNIZE_WORKERS:])
+        for label in labels:
+            response = pending.popleft().result()
+            chunk = next(next_chunks, None)
+            if chunk is not None:
+                pending.append(submit(chunk))
+            yield label, response
+    finally:
+        # エラーや途中終了時は、未完了のリクエストを待たずに破棄する
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def format_transcript(results):
+    """認識結果を話者ごとの Markdown と要約用のプレーンテキストに整形する"""
+    # 文字列の += を繰り返さず、断片をリストに溜めて最後に一度だけ join する
+    transcript_parts = []
+    current_speaker = -1 # 初期化 (話者タグは1から始まることが多い)
+    raw_parts = [] # 要約用のプレーンテキスト
+
+    # 最後の結果に含まれる単語リストから話者タグを取得
+    # Note: results[-1] に全単語情報が含まれるとは限らない場合があるため、
+    # 本来は全 result を舐めるか、LongRunningRecognize の方が確実
+    # ここでは最後の結果を使う簡易的な実装とする
+    if results[-1].alternatives[0].words:
+        for word_info in results[-1].alternatives[0].words:
+            if word_info.speaker_tag != current_speaker:
+                # 先頭の見出しには空行を入れない (後から strip しなくて済むように)
+                separator = "\n\n" if transcript_parts else ""
+                transcript_parts.append(f"{separator}**話者 {word_info.speaker_tag}:**\n")
+                current_speaker = word_info.speaker_tag
+            transcript_parts.append(word_info.word + " ")
+            raw_parts.append(word_info.word + " ")
+    else: # 単語情報がない場合 (短い音声など) は、単純に結合
+        for result in results:
+            transcript_parts.append(result.alternatives[0].transcript + "\n")
+            raw_parts.append(result.alternatives[0].transcript + "\n")
+
+    return "".join(transcript_parts), "".join(raw_parts)
 
 # ----- アプリのタイトル -----
 st.title("🚀 会議文字起こし＆要約アプリ (Google Cloud STT + Gemini)")
@@ -13,11 +180,12 @@ st.write("音声ファイルをアップロードし、文字起こし、話者
 try:
     # Google Cloud STT 用の認証情報
     google_credentials_json_str = st.secrets["google_credentials_json"]
-    google_credentials_dict = json.loads(google_credentials_json_str)
-    credentials = service_account.Credentials.from_service_account_info(google_credentials_dict)
-    speech_client = speech.SpeechClient(credentials=credentials)
+    speech_client = load_speech_client(google_credentials_json_str)
     st.sidebar.success("Google Cloud STT 認証 OK")
 
+    # 長い音声 (約 1 分超) を long_running_recognize で処理するための GCS バケット (任意)
+    gcs_bucket_name = st.secrets.get("gcs_bucket_name")
+
     # Gemini API キー
     #gemini_api_key = st.secrets["gemini_api_key"]
     #genai.configure(api_key=gemini_api_key)
@@ -55,12 +223,19 @@ if uploaded_file is not None:
     if st.button("文字起こしと要約を実行"):
         with st.spinner('音声ファイルを処理し、文字起こしと要約を実行中です...'):
             try:
+                from google.cloud import speech
+
                 # --- Google Cloud STT による文字起こし ---
-                content = uploaded_file.read()
-                audio = speech.RecognitionAudio(content=content)
+                # PyAV で 16kHz モノラル LINEAR16 に変換 (m4a など STT 非対応形式も扱えるようにする)
+                # 同じファイルでの再実行時はキャッシュ済みの PCM を使う
+                content = decode_to_pcm16k(uploaded_file.file_id, uploaded_file)
+                duration_sec = len(content) / (SAMPLE_RATE * 2)
 
                 # 話者分離を有効にした RecognitionConfig
                 config = speech.RecognitionConfig(
+                    encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+                    sample_rate_hertz=SAMPLE_RATE,
+                    audio_channel_count=1,
                     language_code="ja-JP",
                     enable_automatic_punctuation=True,
                     enable_speaker_diarization=True, # 話者分離を有効化
@@ -69,38 +244,47 @@ if uploaded_file is not None:
                 )
 
                 st.info("Google Cloud STT で文字起こしを実行中...")
-                response = speech_client.recognize(config=config, audio=audio)
+                if duration_sec <= INLINE_MAX_SEC:
+                    # 短い音声は同期 recognize にそのまま送る
+                    audio = speech.RecognitionAudio(content=content)
+                    responses = [(None, speech_client.recognize(config=config, audio=audio))]
+                elif gcs_bucket_name:
+                    # 長い音声は GCS 経由で long_running_recognize を使う
+                    storage_client = load_storage_client(google_credentials_json_str)
+                    responses = [(None, long_running_recognize_via_gcs(
+                        speech_client, storage_client, gcs_bucket_name, content, config
+                    ))]
+                else:
+                    # GCS バケットがない場合は分割して並列に recognize する
+                    # (話者タグはチャンクごとに独立して付与されるため、区間ごとに見出しを付ける)
+                    st.info(
+                        f"音声を約 {INLINE_MAX_SEC} 秒ごとの区間に分けて文字起こしします。"
+                        "話者番号は区間ごとに振り直されるため、区間が異なると同じ番号でも同じ話者とは限りません。"
+                    )
+                    responses = recognize_in_chunks(speech_client, content, config)
 
-                if not response.results:
+                # --- 話者分離に基づいたスクリプト整形 ---
+                st.subheader("🗣️ 話者分離 整形済みスクリプト")
+                raw_texts = [] # 要約用のプレーンテキスト
+
+                def stream_transcript():
+                    # 認識が終わったチャンクから順に画面へ表示する
+                    for section_label, response in responses:
+                        if response.results:
+                            transcript_text, raw_text = format_transcript(response.results)
+                            raw_texts.append(raw_text)
+                            if section_label:
+                                yield f"#### 🕒 {section_label}\n\n"
+                            yield transcript_text + "\n\n"
+
+                st.write_stream(stream_transcript()) # Markdownとして表示
+                full_raw_text = "".join(raw_texts)
+
+                if not full_raw_text:
                     st.warning("音声から文字を認識できませんでした。")
                 else:
                     st.success("文字起こしが完了しました。")
 
-                    # --- 話者分離に基づいたスクリプト整形 ---
-                    st.subheader("🗣️ 話者分離 整形済みスクリプト")
-                    transcript_text = ""
-                    current_speaker = -1 # 初期化 (話者タグは1から始まることが多い)
-                    full_raw_text = "" # 要約用のプレーンテキスト
-
-                    # 最後の結果に含まれる単語リストから話者タグを取得
-                    # Note: response.results[-1] に全単語情報が含まれるとは限らない場合があるため、
-                    # 本来は全 result を舐めるか、LongRunningRecognize の方が確実
-                    # ここでは同期認識の最後の結果を使う簡易的な実装とする
-                    if response.results[-1].alternatives[0].words:
-                        for word_info in response.results[-1].alternatives[0].words:
-                            if word_info.speaker_tag != current_speaker:
-                                transcript_text += f"\n\n**話者 {word_info.speaker_tag}:**\n"
-                                current_speaker = word_info.speaker_tag
-                            transcript_text += word_info.word + " "
-                            full_raw_text += word_info.word + " "
-                    else: # 単語情報がない場合 (短い音声など) は、単純に結合
-                        for result in response.results:
-                            transcript_text += result.alternatives[0].transcript + "\n"
-                            full_raw_text += result.alternatives[0].transcript + "\n"
-
-
-                    st.markdown(transcript_text.strip()) # Markdownとして表示
-
                     # --- Gemini API による要約 ---
                     #if can_summarize and full_raw_text:
                     #    st.subheader("📝 AIによる要約 (Gemini)")